@@ -5,29 +5,90 @@
 
 
 import os
+
+# single-threaded Tesseract per worker process beats Tesseract's own OpenMP
+# threading; must be set before libtesseract is loaded
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
 import re
 import json
 import fitz
-import pdfplumber
-import pytesseract
 import random
+import sys
+import pickle
+import hashlib
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from tqdm import tqdm
+except ImportError:
+    tqdm = None
+
+try:
+    from tesserocr import PyTessBaseAPI
+    pytesseract = None
+except ImportError:
+    PyTessBaseAPI = None
+    import pytesseract
 
 # -------------------------------------------------
 # TESSERACT PATH (WINDOWS)
 # -------------------------------------------------
-pytesseract.pytesseract.tesseract_cmd = (
-    r"C:\\Program Files\\Tesseract-OCR\\tesseract.exe"
+# only needed for the pytesseract fallback; tesserocr links libtesseract
+if pytesseract is not None:
+    pytesseract.pytesseract.tesseract_cmd = (
+        r"C:\\Program Files\\Tesseract-OCR\\tesseract.exe"
+    )
+
+# -------------------------------------------------
+# OCR SETTINGS
+# -------------------------------------------------
+# 200 DPI is enough for Tesseract on typed records and has ~2.25x fewer
+# pixels than 300; raise OCR_DPI for small print
+OCR_DPI = int(os.environ.get("OCR_DPI", 200))
+
+# LSTM engine only (oem 1), page read as one uniform block of text (psm 6);
+# used for both the tesserocr API and the tesseract CLI flags
+TESSERACT_OEM = 1
+TESSERACT_PSM = 6
+TESSERACT_CONFIG = f"--oem {TESSERACT_OEM} --psm {TESSERACT_PSM}"
+
+# Tesseract runs single-threaded (OMP_THREAD_LIMIT above), so use one
+# worker process per core (at most 8 by default; each holds a rendered
+# page and a loaded model). Set OCR_CONCURRENCY=1 to OCR pages serially.
+OCR_CONCURRENCY = int(
+    os.environ.get("OCR_CONCURRENCY", min(os.cpu_count() or 1, 8))
 )
 
 # -------------------------------------------------
 # CLEAN TEXT
 # -------------------------------------------------
+_RE_SPACES = re.compile(r" +")
+_RE_NEWLINES = re.compile(r"\n{3,}")
+# tabs and no-break spaces (common in PDF text layers) become plain spaces
+_SPACE_TABLE = str.maketrans({"\t": " ", "\xa0": " "})
+
 def clean(text):
     if not text:
         return ""
-    text = text.replace("\t", " ")
-    text = re.sub(r" +", " ", text)
-    text = re.sub(r"\n{3,}", "\n\n", text)
+    text = text.translate(_SPACE_TABLE)
+    text = _RE_SPACES.sub(" ", text)
+    text = _RE_NEWLINES.sub("\n\n", text)
     return text.strip()
 
 # -------------------------------------------------
@@ -35,62 +96,290 @@ def clean(text):
 # -------------------------------------------------
 def load_json(path, default=None):
     if os.path.exists(path):
+        if orjson is not None:
+            with open(path, "rb") as f:
+                return orjson.loads(f.read())
         with open(path, "r", encoding="utf-8") as f:
             return json.load(f)
     return default if default is not None else {}
 
 def save_json(path, data):
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        return
     with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+        json.dump(data, f, indent=2, ensure_ascii=False)
+
+# -------------------------------------------------
+# TESSERACT
+# -------------------------------------------------
+_tess_api = None
+
+# the rendered image carries no resolution tag, so pass the DPI it was
+# rendered at; otherwise Tesseract guesses (usually 70) and scales badly
+def run_tesseract(pix, dpi):
+    global _tess_api
+    if PyTessBaseAPI is None:
+        # pipe the PNG PyMuPDF already encodes straight into the tesseract
+        # CLI; pytesseract would re-encode a PIL image into a temp file
+        try:
+            result = subprocess.run(
+                [
+                    pytesseract.pytesseract.tesseract_cmd, "stdin", "stdout",
+                    "-l", "eng", *TESSERACT_CONFIG.split(), "--dpi", str(dpi)
+                ],
+                input=pix.tobytes("png"),
+                capture_output=True,
+                # no console window per page on Windows (as pytesseract does)
+                creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0)
+            )
+        except FileNotFoundError:
+            raise pytesseract.TesseractNotFoundError() from None
+        if result.returncode != 0:
+            raise pytesseract.TesseractError(
+                result.returncode,
+                result.stderr.decode("utf-8", errors="replace")
+            )
+        return result.stdout.decode("utf-8")
+
+    # load the model once per process and reuse it for every page
+    if _tess_api is None:
+        _tess_api = PyTessBaseAPI(
+            lang="eng", psm=TESSERACT_PSM, oem=TESSERACT_OEM
+        )
+    # hand the raw pixmap buffer straight to libtesseract, no PIL image
+    _tess_api.SetImageBytes(
+        pix.samples, pix.width, pix.height, pix.n, pix.stride
+    )
+    _tess_api.SetSourceResolution(dpi)
+    return _tess_api.GetUTF8Text()
 
 # -------------------------------------------------
 # OCR PAGE
 # -------------------------------------------------
-def extract_text_from_page(pdf_path, page_index):
-    with pdfplumber.open(pdf_path) as pdf:
-        page = pdf.pages[page_index]
-        img = page.to_image(resolution=300)
-        return clean(pytesseract.image_to_string(img.original))
+# pages whose embedded text layer has at least this many words are
+# born-digital: use the text layer and skip rasterizing + Tesseract.
+# scans with a stamped header/footer have words too, so pages mostly
+# covered by images are still OCR'd
+TEXT_LAYER_MIN_WORDS = 20
+TEXT_LAYER_MAX_IMAGE_COVERAGE = 0.5
+
+def image_coverage(page):
+    page_area = abs(page.rect)
+    if not page_area:
+        return 0.0
+    covered = sum(
+        abs(fitz.Rect(info["bbox"]) & page.rect)
+        for info in page.get_image_info()
+    )
+    return min(covered / page_area, 1.0)
+
+# memo: dict shared by the pages of one run (one per worker process)
+def extract_text_from_page(doc, page_index, cache_dir=None, dpi=OCR_DPI,
+                           memo=None):
+    page = doc.load_page(page_index)
+
+    page_text = page.get_text("text")
+    if (len(page_text.split()) >= TEXT_LAYER_MIN_WORDS
+            and image_coverage(page) < TEXT_LAYER_MAX_IMAGE_COVERAGE):
+        return clean(page_text)
+
+    # Tesseract binarizes anyway; one gray channel is a third of RGB
+    pix = page.get_pixmap(
+        matrix=fitz.Matrix(dpi / 72, dpi / 72),
+        colorspace=fitz.csGRAY
+    )
+
+    # OCR results keyed by the rendered image: identical pages (repeated
+    # cover sheets, boilerplate) are OCR'd once per run, and the disk
+    # cache lets reruns skip Tesseract
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(
+        f"{pix.width}x{pix.height}x{pix.n} {dpi} {TESSERACT_CONFIG}".encode()
+    )
+    digest.update(pix.samples_mv)
+    page_hash = digest.hexdigest()
+
+    if memo is None:
+        memo = {}
+    if page_hash in memo:
+        return memo[page_hash]
+
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, f"{page_hash}.txt")
+
+        if os.path.exists(cache_path):
+            with open(cache_path, "r", encoding="utf-8") as f:
+                text = memo[page_hash] = f.read()
+            return text
+
+    text = memo[page_hash] = clean(run_tesseract(pix, dpi))
+
+    if cache_path:
+        # write to a temp file and rename it into place, so an interrupted
+        # run or a concurrent reader never sees a partial cache entry. the
+        # cache is best-effort: a failed write (disk full, permissions)
+        # costs a re-OCR next run, not this run
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            # on Windows the rename fails while another worker reads the
+            # same entry it just wrote; that entry is complete, keep it
+            if not os.path.exists(cache_path):
+                print(f"⚠ Could not write OCR cache entry {cache_path}: {e}")
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    return text
+
+# fitz documents can't be pickled, so each OCR worker opens the PDF once
+# in its initializer (from the bytes already read by process_pdf) and
+# reuses it for every page it is given
+_worker_doc = None
+_worker_memo = None
+
+def _init_ocr_worker(pdf_bytes):
+    global _worker_doc, _worker_memo
+    _worker_doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    _worker_memo = {}
+
+def _ocr_worker_page(page_index, cache_dir, dpi):
+    try:
+        return extract_text_from_page(
+            _worker_doc, page_index, cache_dir, dpi, _worker_memo
+        )
+    # errors travel back to the parent pickled; some (TesseractNotFoundError)
+    # can't be rebuilt there and would look like a broken pool, so send a
+    # plain RuntimeError that carries the message instead
+    except Exception as e:
+        raise RuntimeError(
+            f"OCR failed on page {page_index + 1}: "
+            f"{type(e).__name__}: {e}"
+        ) from e
+
+# spawn/forkserver workers re-import __main__ to find the worker functions;
+# a notebook or REPL has no file to import, so only fork can work there
+def _can_use_ocr_pool():
+    if getattr(sys.modules.get("__main__"), "__file__", None):
+        return True
+    return multiprocessing.get_start_method() == "fork"
+
+# yields page texts in order as they finish, so only pages not yet
+# sanitized are held in memory
+def ocr_pages(doc, pdf_bytes, page_indices, cache_dir=None, dpi=OCR_DPI):
+    done = 0
+
+    if (OCR_CONCURRENCY > 1 and len(page_indices) > 1
+            and _can_use_ocr_pool()):
+        workers = min(OCR_CONCURRENCY, len(page_indices))
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_ocr_worker,
+            initargs=(pdf_bytes,)
+        )
+        try:
+            for text in executor.map(
+                _ocr_worker_page,
+                page_indices,
+                [cache_dir] * len(page_indices),
+                [dpi] * len(page_indices)
+            ):
+                yield text
+                done += 1
+            return
+        # workers that can't be started or die (e.g. unpicklable functions
+        # under spawn) shouldn't sink the run; finish the rest in-process.
+        # OCR errors inside a worker arrive as RuntimeError and propagate
+        except (BrokenProcessPool, pickle.PicklingError):
+            print("⚠ OCR worker processes failed; continuing serially")
+        # also runs when the caller closes the generator early (a page
+        # failed): drop the pages not started yet instead of OCR'ing them
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    memo = {}
+    for i in page_indices[done:]:
+        yield extract_text_from_page(doc, i, cache_dir, dpi, memo)
+
+# -------------------------------------------------
+# FIND PII PAGE FILES
+# -------------------------------------------------
+_RE_PII_PAGE = re.compile(r"pii_page_(\d+)\.json")
+
+def find_pii_pages(output_dir):
+    pages = {}
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            m = _RE_PII_PAGE.fullmatch(entry.name)
+            if m and entry.is_file():
+                pages[int(m.group(1))] = entry.path
+    return pages
 
 # -------------------------------------------------
 # PICK DUMMY VALUE
 # -------------------------------------------------
-def pick_dummy(field, dummy_pool, used_dummies):
+def build_unused_dummies(dummy_pool, used_dummies):
+    return {
+        field: [o for o in options if o not in used_dummies]
+        for field, options in dummy_pool.items()
+    }
+
+def pick_dummy(field, dummy_pool, used_dummies, unused_dummies):
     options = dummy_pool.get(field, [])
     if not options:
         return "REDACTED"
 
-    unused = [o for o in options if o not in used_dummies]
-    return random.choice(unused if unused else options)
+    # random draw from the field's unused list (swap-remove, O(1)); entries
+    # another field has taken since the list was built are dropped on the way
+    unused = unused_dummies.get(field, [])
+    while unused:
+        i = random.randrange(len(unused))
+        unused[i], unused[-1] = unused[-1], unused[i]
+        dummy = unused.pop()
+        if dummy not in used_dummies:
+            return dummy
+
+    return random.choice(options)
+
+# -------------------------------------------------
+# INDEX MASTER (dummies in use + original -> dummy)
+# -------------------------------------------------
+def index_master_pii(master_pii):
+    used_dummies = set()
+    original_to_dummy = {}
+
+    for page in master_pii.values():
+        for entry in page.values():
+            used_dummies.add(entry["dummy"])
+            original_to_dummy.setdefault(entry["original"], entry["dummy"])
+
+    return used_dummies, original_to_dummy
 
 # -------------------------------------------------
 # UPDATE MASTER + CREATE REPLACE_PAGE_N
 # -------------------------------------------------
-def build_replace_page(page_no, extracted_pii, dummy_pool, master_pii):
+def build_replace_page(page_no, extracted_pii, dummy_pool, master_pii,
+                       used_dummies, original_to_dummy, unused_dummies):
     page_key = f"page_{page_no}"
     replace_page = {}
 
-    used_dummies = {
-        v["dummy"]
-        for p in master_pii.values()
-        for v in p.values()
-    }
-
     for field, original in extracted_pii.items():
-        dummy = None
-
         # reuse existing dummy if original already mapped
-        for page in master_pii.values():
-            for entry in page.values():
-                if entry["original"] == original:
-                    dummy = entry["dummy"]
-                    break
-            if dummy:
-                break
+        dummy = original_to_dummy.get(original)
 
         if not dummy:
-            dummy = pick_dummy(field, dummy_pool, used_dummies)
+            dummy = pick_dummy(
+                field, dummy_pool, used_dummies, unused_dummies
+            )
             used_dummies.add(dummy)
+            original_to_dummy[original] = dummy
 
         replace_page[field] = {
             "original": original,
@@ -103,6 +392,40 @@ def build_replace_page(page_no, extracted_pii, dummy_pool, master_pii):
 # -------------------------------------------------
 # SAFE REPLACEMENT (EMBEDDED STRINGS OK)
 # -------------------------------------------------
+# matchers are cached by content: the same PII usually repeats across pages
+@lru_cache(maxsize=128)
+def _build_automaton(pairs):
+    automaton = ahocorasick.Automaton()
+    for original, dummy in pairs:
+        automaton.add_word(original, (len(original), dummy))
+    automaton.make_automaton()
+    return automaton
+
+# fallback without pyahocorasick: a lookahead alternation is zero-width,
+# so finditer stops at every position where some value starts, including
+# positions inside another match
+@lru_cache(maxsize=128)
+def _build_pattern(pairs):
+    return re.compile(
+        "(?=" + "|".join(re.escape(original) for original, _ in pairs) + ")"
+    )
+
+# every (start, end, dummy) occurrence of every value in `lowered`
+def _find_matches(lowered, pairs):
+    if ahocorasick is not None:
+        return [
+            (end - length + 1, end + 1, dummy)
+            for end, (length, dummy) in _build_automaton(pairs).iter(lowered)
+        ]
+
+    matches = []
+    for m in _build_pattern(pairs).finditer(lowered):
+        start = m.start()
+        for original, dummy in pairs:
+            if lowered.startswith(original, start):
+                matches.append((start, start + len(original), dummy))
+    return matches
+
 def replace_from_map(text, replace_map):
     entries = sorted(
         replace_map.values(),
@@ -110,103 +433,127 @@ def replace_from_map(text, replace_map):
         reverse=True
     )
 
+    pairs = {}
     for e in entries:
-        if not e["original"].strip():
-            continue
+        original = e["original"].lower()
+        if original.strip():
+            pairs.setdefault(original, e["dummy"])
 
-        text = re.sub(
-            re.escape(e["original"]),
-            e["dummy"],
-            text,
-            flags=re.IGNORECASE
-        )
-
-    return text
-
-# -------------------------------------------------
-# SECOND PASS: STRICTLY USE replace_page_n.json
-# -------------------------------------------------
-def final_replace_using_replace_page(page_no, output_dir):
-    pii_path = os.path.join(output_dir, f"pii_page_{page_no}.json")
-    replace_path = os.path.join(output_dir, f"replace_page_{page_no}.json")
-    txt_path = os.path.join(output_dir, f"page_{page_no}_sanitized.txt")
+    if not pairs:
+        return text
 
-    if not (os.path.exists(pii_path)
-            and os.path.exists(replace_path)
-            and os.path.exists(txt_path)):
-        return
+    pairs = tuple(pairs.items())
 
-    pii_values = load_json(pii_path)
-    replace_page = load_json(replace_path)
+    # match on a lowercased copy; offsets must stay aligned with `text`
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        lowered = "".join(
+            c.lower() if len(c.lower()) == 1 else c for c in text
+        )
 
-    with open(txt_path, "r", encoding="utf-8") as f:
-        text = f.read()
+    matches = sorted(
+        _find_matches(lowered, pairs),
+        key=lambda m: (m[0] - m[1], m[0])
+    )
 
-    for value in pii_values.values():
-        for entry in replace_page.values():
-            if entry["original"] == value:
-                text = re.sub(
-                    re.escape(value),
-                    entry["dummy"],
-                    text,
-                    flags=re.IGNORECASE
-                )
+    # longest match wins, same as replacing longer values first
+    taken = bytearray(len(text))
+    spans = []
+    for start, end, dummy in matches:
+        if any(taken[start:end]):
+            continue
+        taken[start:end] = b"\x01" * (end - start)
+        spans.append((start, end, dummy))
 
-    with open(txt_path, "w", encoding="utf-8") as f:
-        f.write(text)
+    spans.sort()
+    parts = []
+    pos = 0
+    for start, end, dummy in spans:
+        parts.append(text[pos:start])
+        parts.append(dummy)
+        pos = end
+    parts.append(text[pos:])
 
-    print(f"✔ Final enforced replacement done for page {page_no}")
+    return "".join(parts)
 
 # -------------------------------------------------
 # MAIN PIPELINE
 # -------------------------------------------------
-def process_pdf(pdf_path, output_dir, dummy_file):
-    os.makedirs(output_dir, exist_ok=True)
+def process_pdf(pdf_path, output_dir, dummy_file, dpi=OCR_DPI):
+    # creates output_dir as well
+    ocr_cache_dir = os.path.join(output_dir, ".ocr_cache")
+    os.makedirs(ocr_cache_dir, exist_ok=True)
 
     dummy_pool = load_json(dummy_file)
     master_path = os.path.join(output_dir, "master_pii.json")
     master_pii = load_json(master_path, {})
-
-    doc = fitz.open(pdf_path)
-
-    for i in range(len(doc)):
-        page_no = i + 1
-        print(f"\nProcessing page {page_no}")
-
-        text = extract_text_from_page(pdf_path, i)
-
-        pii_path = os.path.join(output_dir, f"pii_page_{page_no}.json")
-        extracted_pii = load_json(pii_path)
-
-        if not extracted_pii:
-            print("⚠ No pii_page file")
-            continue
-
-        # 1️⃣ Build replace_page_n.json + update master
-        replace_page = build_replace_page(
-            page_no,
-            extracted_pii,
-            dummy_pool,
-            master_pii
-        )
-
-        save_json(
-            os.path.join(output_dir, f"replace_page_{page_no}.json"),
-            replace_page
-        )
+    used_dummies, original_to_dummy = index_master_pii(master_pii)
+    unused_dummies = build_unused_dummies(dummy_pool, used_dummies)
+
+    # read from disk once; pages are rendered from this document (or from
+    # one per OCR worker process, opened from the same bytes)
+    with open(pdf_path, "rb") as f:
+        pdf_bytes = f.read()
+
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    texts = None
+    try:
+        # only pages with a non-empty pii_page_n.json are OCR'd
+        page_pii = {}
+        for page_no, pii_path in sorted(find_pii_pages(output_dir).items()):
+            if not 1 <= page_no <= len(doc):
+                continue
+            extracted_pii = load_json(pii_path)
+            if extracted_pii:
+                page_pii[page_no] = extracted_pii
+
+        skipped = len(doc) - len(page_pii)
+        if skipped:
+            print(f"⚠ No pii_page file for {skipped} page(s)")
+
+        # OCR is independent per page; the replacement pass below is not
+        page_indices = [page_no - 1 for page_no in page_pii]
+        texts = ocr_pages(doc, pdf_bytes, page_indices, ocr_cache_dir, dpi)
+
+        pages = zip(page_pii, texts)
+        if tqdm is not None:
+            pages = tqdm(pages, total=len(page_pii), unit="page")
+
+        for page_no, text in pages:
+            extracted_pii = page_pii[page_no]
+
+            # 1️⃣ Build replace_page_n.json + update master
+            replace_page = build_replace_page(
+                page_no,
+                extracted_pii,
+                dummy_pool,
+                master_pii,
+                used_dummies,
+                original_to_dummy,
+                unused_dummies
+            )
+
+            save_json(
+                os.path.join(output_dir, f"replace_page_{page_no}.json"),
+                replace_page
+            )
+
+            # 2️⃣ Sanitize page text
+            sanitized = replace_from_map(text, replace_page)
+            sanitized_path = os.path.join(
+                output_dir, f"page_{page_no}_sanitized.txt"
+            )
+
+            with open(sanitized_path, "w", encoding="utf-8") as f:
+                f.write(sanitized)
+    finally:
+        # written once, also when a page fails, so it matches the
+        # replace_page_n.json files written so far
         save_json(master_path, master_pii)
-
-        # 2️⃣ First sanitization
-        sanitized = replace_from_map(text, replace_page)
-        sanitized_path = os.path.join(
-            output_dir, f"page_{page_no}_sanitized.txt"
-        )
-
-        with open(sanitized_path, "w", encoding="utf-8") as f:
-            f.write(sanitized)
-
-        # 3️⃣ Enforced second-pass replacement
-        final_replace_using_replace_page(page_no, output_dir)
+        # stops the OCR workers if a page failed before all were read
+        if texts is not None:
+            texts.close()
+        doc.close()
 
     print("\n✅ PIPELINE COMPLETED SUCCESSFULLY")
 